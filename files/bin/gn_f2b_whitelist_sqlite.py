@@ -22,20 +22,54 @@ Externalities:
 """
 
 from pathlib import Path
+import os
 import sqlite3
 import time
 from datetime import datetime, timedelta
 import subprocess
 import sys
 import ipaddress
+import functools
+import collections
+import mmap
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 # Oldest records in journal db table
 RECORDS_MAX_AGE = 30
+# Days to keep whois results in whois_cache db table
+WHOIS_MAX_AGE = 30
+# Parallel whois queries for IPs not found in whois_cache
+WHOIS_WORKERS = 16
 
 DB_PATH = Path('/etc/fail2ban/jail.d/gn_whitelist.db')
 LOG_FILENAME = '/var/log/gn_f2b_mail.log'
 IGNORE_DRAFT_FNAME = '/etc/fail2ban/jail.d/gn-ignoreip.draft'
 
+# SQLite tuning applied on every db_open.
+# WAL turns each commit into an append to the -wal file instead of rewriting
+# the rollback journal. With synchronous=NORMAL the WAL is not fsynced on every
+# commit - a power loss may lose the last ingest run, but the DB stays
+# consistent. That is acceptable here: lost lines are re-read from mail log
+# on the next run. Use synchronous=FULL if you need every commit durable.
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL;',
+    'PRAGMA synchronous=NORMAL;',
+    'PRAGMA temp_store=MEMORY;',
+    'PRAGMA cache_size=-8000;',
+    # Keep dirty pages of the running ingest transaction in memory until commit.
+    'PRAGMA cache_spill=0;',
+)
+
+# Journal indexes - GROUP BY ip, username in QUERY walks the first one in order,
+# db_delete_old_records uses the second one.
+JOURNAL_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_journal_ip_user ON journal (ip, username);',
+    'CREATE INDEX IF NOT EXISTS idx_journal_ts ON journal (timestamp);',
+)
+
+_INSERT_SQL = 'INSERT INTO journal (timestamp, ip, username, backend) VALUES (?, ?, ?, ?)'
+
 QUERY = """
 SELECT ip, username, count(*) AS cnt
     FROM journal
@@ -67,6 +101,64 @@ FINDERS = [
 ]
 
 
+def _to_bytes(value):
+    """Encode str to bytes, leave None as is"""
+    return value.encode() if value is not None else None
+
+def between_extractor(first, last):
+    """Return function extracting text between two chars - brackets i.e.
+
+        If provided value None as first or last it results in start or end of text.
+        Delimiters are baked in, so the returned function just slices.
+    """
+    if first and last:
+        return lambda text: text[text.index(first) + 1:text.index(last)]
+    if first:
+        return lambda text: text[text.index(first) + 1:]
+    if last:
+        return lambda text: text[:text.index(last)]
+    return lambda text: text
+
+def field_extractor(start, first, last):
+    """Return function extracting value of log line field (token) starting with start
+
+        Field value is text between first and last chars (see between_extractor).
+        Returned function finds the field directly in the line and gives b''
+        if there is no such field.
+    """
+    # Field is always preceded by space - do not match 'rip=' inside 'orig_rip=' etc.
+    marker = b' ' + start
+    between = between_extractor(first, last)
+
+    def extract(line):
+        pos = line.find(marker)
+        if pos < 0:
+            return b''
+        end = line.find(b' ', pos + 1)
+        return between(line[pos + 1:end if end >= 0 else None].rstrip())
+
+    return extract
+
+# FINDERS prepared for matching raw bytes of the log lines - tuples avoid
+# dict lookups and bytes avoid decoding every line in the hot loop.
+# (fstring, skip, (extract_user, extract_ip, backend))
+FINDERS_B = [
+    (
+        _to_bytes(f['fstring']),
+        _to_bytes(f['skip']),
+        (
+            field_extractor(_to_bytes(f['user_start']), *(_to_bytes(c) for c in f['user_between'])),
+            field_extractor(_to_bytes(f['ip_start']), *(_to_bytes(c) for c in f['ip_between'])),
+            f['backend'],
+        ),
+    )
+    for f in FINDERS
+]
+# Failed logins of any backend - never take such line as whitelist evidence.
+# One regex alternation is a single C level scan for all skip strings.
+_SKIP_RE = re.compile(b'|'.join(re.escape(f[1]) for f in FINDERS_B))
+
+
 IGNORES_HEADER = """
 # This file is generated by script /usr/local/bin/gn_f2b_whitelist_sqlite.py
 
@@ -78,61 +170,125 @@ IGNORES_HEADER = """
 
 """
 
-def convert_time(time_from_log):
-    """Convert timestamp from log file format to DB format"""
-    # time_from_log = 'Mar 25 14:27:47' or '2024-03-25T14:27:47'
-    if time_from_log.startswith('2'):
-        tstamp = time_from_log[:19]
-    else:
-        curr_year = time.localtime().tm_year
-        py_time = time.strptime(f'{curr_year} {time_from_log[:15]}', '%Y %b %d %H:%M:%S')
-        tstamp = time.strftime('%Y-%m-%dT%H:%M:%S', py_time)
-    return tstamp
+# Month abbreviations in syslog timestamps -> month number
+_MONTHS = {
+    b'Jan': 1, b'Feb': 2, b'Mar': 3, b'Apr': 4, b'May': 5, b'Jun': 6,
+    b'Jul': 7, b'Aug': 8, b'Sep': 9, b'Oct': 10, b'Nov': 11, b'Dec': 12,
+}
 
-def extract_between(text, first, last):
-    """Extract text between two chars - brackets i.e.
+# Syslog timestamps have no year - use the current one (read once per run).
+_CURR_YEAR = time.localtime().tm_year
 
-        If provided value None as first or last it results in start or end of text.
-    """
-    start = text.index(first) + 1 if first else None
-    end = text.index(last) if last else None
-    return text[start:end]
+@functools.lru_cache(maxsize=None)
+def _hour_start(year, month, day, hour):
+    """Return unix epoch of start of given local hour (DST aware)"""
+    return int(datetime(year, month, day, hour).timestamp())
+
+def convert_time(time_from_log):
+    """Convert timestamp (bytes) from log file format to DB format - unix epoch"""
+    # time_from_log = b'Mar 25 14:27:47' or b'2024-03-25T14:27:47'
+    # Both are local time. Epoch of the hour start is cached - DST offset can
+    # change only on a whole hour - minutes and seconds are simply added.
+    if time_from_log.startswith(b'2'):
+        year, month, day = int(time_from_log[0:4]), int(time_from_log[5:7]), int(time_from_log[8:10])
+        hms = time_from_log[11:19]
+    else:
+        # Day is space padded: b'Mar  5 14:27:47'
+        year, month, day = _CURR_YEAR, _MONTHS[time_from_log[0:3]], int(time_from_log[4:6])
+        hms = time_from_log[7:15]
+    return _hour_start(year, month, day, int(hms[0:2])) + int(hms[3:5]) * 60 + int(hms[6:8])
 
+@functools.lru_cache(maxsize=None)
 def whois_bits(ip):
     """Return string with country code and netname from whois"""
     sp = subprocess.run(('whois', ip), capture_output=True)
     if sp.returncode != 0:
         return ''
-    lines = sp.stdout.decode().splitlines()
-    country = ''
-    netname = ''
-    for line in lines:
+    country = b''
+    netname = b''
+    for line in sp.stdout.splitlines():
+        # Only lines starting with c/n are interesting - skip the rest cheaply.
+        if line[:1] not in (b'c', b'C', b'n', b'N'):
+            continue
         line = line.lower()
-        if line.startswith('country'):
-            country = line.split(':')[1].strip()
-        elif line.startswith('netname:'):
-            netname = line.split(':')[1].strip()
+        # Last match wins - i.e. ARIN lists parent allocation first and
+        # the more specific reassignment after it.
+        if line.startswith(b'country'):
+            country = line.split(b':')[1].strip()
+        elif line.startswith(b'netname:'):
+            netname = line.split(b':')[1].strip()
+    country = country.decode(errors='replace')
+    netname = netname.decode(errors='replace')
     return f'{country} {netname}'[:21]
 
+def parse_log_lines(logfile, max_timestamp):
+    """Yield (timestamp, ip, user, backend) for relevant lines of log file
+
+    logfile is file opened in binary mode or mmap - anything with readline,
+    seek and tell. When done, logfile position is just after the last
+    complete line.
+    """
+    # Unterminated last line (missing final newline or being written right now)
+    # is processed too, but position is left at its start so it is read again
+    # next time - max_timestamp check drops the duplicate then.
+    unterminated = 0
+    for line in iter(logfile.readline, b''):
+        if not line.endswith(b'\n'):
+            unterminated = len(line)
+
+        # Is this line worth to bother with? Lines matching no finder are dropped.
+        finder = None
+        for fstring, skip, finder_data in FINDERS_B:
+            if fstring in line:
+                finder = finder_data
+                break
+        if finder is None:
+            continue
+        # If reason to skip line read next line
+        if _SKIP_RE.search(line):
+            continue
+
+        timestamp = convert_time(line[0:19])
+        # Skip lines already processed in previous run of this script.
+        if timestamp <= max_timestamp:
+            continue
+        extract_user, extract_ip, backend = finder
+
+        # This is "our" line :-) Let's get data - fields are found directly,
+        # splitting whole line to tokens is the most expensive part otherwise.
+        user = extract_user(line)
+        ip = extract_ip(line)
+        if not (ip and user):
+            continue
+
+        yield timestamp, ip.decode(errors='replace'), user.decode(errors='replace'), backend
+
+    if unterminated:
+        logfile.seek(-unterminated, os.SEEK_CUR)
+
 class Whitelist:
 
     def __init__(self) -> None:
 
         self.db_conn = None
         self.db_cursor = None
-        if not Path(LOG_FILENAME).exists():
-            Path(LOG_FILENAME).touch(mode=0o640)
         self.db_open()
         # IP -> (user, count) dict created from db records
-        self.records = dict()
+        self.records = collections.defaultdict(list)
+        # Sorted keys of self.records - set by read_db_to_dict
+        self._sorted_keys = list()
+        # Text of fail2ban ignoreip draft file
+        self.draft = ''
 
     def _db_create(self):
 
         DB_PATH.parent.mkdir(parents=True, exist_ok=True)
         db_conn = sqlite3.connect(str(DB_PATH))
         db_cursor = db_conn.cursor()
-        db_cursor.execute('CREATE TABLE journal (timestamp str, ip str, username str, backend str);')
+        db_cursor.execute('CREATE TABLE journal (timestamp INTEGER, ip str, username str, backend str);')
         db_cursor.execute('CREATE TABLE known_ranges (ip str, mask int, last_seen str);')
+        for index in JOURNAL_INDEXES:
+            db_cursor.execute(index)
         db_conn.commit()
         db_conn.close()
 
@@ -142,8 +298,69 @@ class Whitelist:
             self._db_create()
 
         self.db_conn = sqlite3.connect(str(DB_PATH))
+        for pragma in DB_PRAGMAS:
+            self.db_conn.execute(pragma)
+        self._db_migrate_timestamps()
+        # Key/value store for state between runs. IF NOT EXISTS also upgrades
+        # DBs created by older versions of this script.
+        self.db_conn.execute('CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text);')
+        self.db_conn.execute('CREATE TABLE IF NOT EXISTS whois_cache (ip text PRIMARY KEY, info text, fetched_at text);')
+        for index in JOURNAL_INDEXES:
+            self.db_conn.execute(index)
         self.db_cursor = self.db_conn.cursor()
 
+    def _db_migrate_timestamps(self):
+        """Rebuild journal table with text timestamps from older versions to unix epoch"""
+
+        columns = {row[1]: row[2] for row in self.db_conn.execute('PRAGMA table_info(journal);')}
+        if columns.get('timestamp', '').upper() == 'INTEGER':
+            return
+        # Old timestamps are local time - 'utc' modifier converts them to UTC epoch.
+        with self.db_conn:
+            # Leftover of interrupted migration
+            self.db_conn.execute('DROP TABLE IF EXISTS journal_new;')
+            self.db_conn.execute('CREATE TABLE journal_new (timestamp INTEGER, ip str, username str, backend str);')
+            self.db_conn.execute(
+                "INSERT INTO journal_new (timestamp, ip, username, backend) "
+                "SELECT CAST(strftime('%s', timestamp, 'utc') AS INTEGER), ip, username, backend FROM journal;"
+            )
+            self.db_conn.execute('DROP TABLE journal;')
+            self.db_conn.execute('ALTER TABLE journal_new RENAME TO journal;')
+
+    def _meta_get(self, key, default=None):
+        """Return value stored in meta table or default"""
+        row = self.db_conn.execute('SELECT value FROM meta WHERE key = ?', (key, )).fetchone()
+        return row[0] if row else default
+
+    def _meta_set(self, key, value):
+        """Store value in meta table - caller commits"""
+        self.db_conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def whois_infos(self, ips):
+        """Return dict ip -> whois_bits - from whois_cache table if fresh enough
+
+        IPs missing in cache are queried by whois in parallel threads.
+        """
+        fresh_since = (datetime.now() - timedelta(days=WHOIS_MAX_AGE)).strftime('%Y-%m-%dT%H:%M:%S')
+        infos = dict(self.db_conn.execute(
+            'SELECT ip, info FROM whois_cache WHERE fetched_at >= ?',
+            (fresh_since, )
+        ))
+        missing = [ip for ip in ips if ip not in infos]
+        # whois is waiting for network mostly - threads are fine, DB stays in this thread.
+        with ThreadPoolExecutor(max_workers=WHOIS_WORKERS) as executor:
+            fetched = dict(zip(missing, executor.map(whois_bits, missing)))
+        fetched_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        # Failed lookup (or reply without country/netname, i.e. rate limit
+        # denial, gives ' ') - do not cache, try again next time.
+        with self.db_conn:
+            self.db_conn.executemany(
+                'INSERT OR REPLACE INTO whois_cache (ip, info, fetched_at) VALUES (?, ?, ?)',
+                ((ip, info, fetched_at) for ip, info in fetched.items() if info.strip())
+            )
+        infos.update(fetched)
+        return infos
+
     def process_new_log_records(self):
         """Read new records from mail.log and save relevant do database."""
 
@@ -151,46 +368,27 @@ class Whitelist:
         self.db_cursor.execute('SELECT max(timestamp) FROM journal;')
         max_timestamp = self.db_cursor.fetchone()[0]
         if max_timestamp is None:
-            max_timestamp = ''
-
-        with open(LOG_FILENAME, 'r') as logfile:
-            for line in logfile:
-
-                timestamp = convert_time(line[0:19])
-                # Skip lines already processed in previous run of this script.
-                if timestamp <= max_timestamp:
-                    continue
-
-                # Is this line worth to bother with?
-                bother_with_this_line = False
-                for find_item in FINDERS:
-                    # If reason to skip line read next line
-                    if line.find(find_item['skip']) > 0:
-                        break
-                    # Is it wanted string?
-                    if line.find(find_item['fstring']) < 0:
-                        continue
-                    else:
-                        bother_with_this_line = True
-                        break
-                if not bother_with_this_line:
-                    continue
-
-                # This is "our" line :-) Let's get data.
-                ip: str = ''
-                user: str = ''
-                for part in line.split():
-                    if part.startswith(find_item['user_start']):
-                        user = extract_between(part, find_item['user_between'][0], find_item['user_between'][1])
-                    elif part.startswith(find_item['ip_start']):
-                        # ip = extract_between(part, '=', ',')
-                        ip = extract_between(part, find_item['ip_between'][0], find_item['ip_between'][1])
-                if not (ip and user):
-                    continue
-                backend = find_item['backend']
-
-                self.db_cursor.execute('INSERT INTO journal (timestamp, ip, username, backend) VALUES (?, ?, ?, ?)', (timestamp, ip, user, backend))
-        self.db_conn.commit()
+            max_timestamp = 0
+
+        # Rows are streamed from the parser straight to executemany in one
+        # transaction - committing each row separately costs a fsync per line.
+        # Log is scanned as read-only mmap - raw bytes straight from page cache,
+        # only the few matched lines need to be decoded.
+        with open(LOG_FILENAME, 'rb') as logfile, self.db_conn:
+            # Continue where the previous run stopped if it is still the same file.
+            # Rotated log (different inode) or truncated log is read from start.
+            log_stat = os.fstat(logfile.fileno())
+            offset = int(self._meta_get('last_offset', 0))
+            if self._meta_get('last_inode') != str(log_stat.st_ino) or offset > log_stat.st_size:
+                offset = 0
+            # Nothing new (mmap of empty file is not possible anyway).
+            if offset < log_stat.st_size:
+                with mmap.mmap(logfile.fileno(), log_stat.st_size, access=mmap.ACCESS_READ) as log_map:
+                    log_map.seek(offset)
+                    self.db_conn.executemany(_INSERT_SQL, parse_log_lines(log_map, max_timestamp))
+                    offset = log_map.tell()
+            self._meta_set('last_inode', log_stat.st_ino)
+            self._meta_set('last_offset', offset)
 
     def read_db_to_dict(self):
         """Read records from database to dictionary for easier processing"""
@@ -202,8 +400,8 @@ class Whitelist:
             ip_kr, prefix, last_seen = qq
             ranges.append(f'{ip_kr}/{prefix}')
 
-        # Read records from db to dict
-        for qq in self.db_cursor.execute(QUERY):
+        # Read records from db to dict - aggregated result is small, fetch it at once
+        for qq in self.db_cursor.execute(QUERY).fetchall():
             ip, username, count = qq
             # Is ip address in any of known ranges? -> reduce IP to net range
             for ip_range in ranges:
@@ -215,10 +413,13 @@ class Whitelist:
                     break
             # IPv6 ? - Do not save all /128 but just /64
             if ip.count(':') > 4:
-                ip = ':'.join(ip.split(':')[:4]) + '::/64'
-            if not self.records.get(ip):
-                self.records[ip] = list()
+                # Cut after 4th group - slice once, no split/join.
+                end = -1
+                for _ in range(4):
+                    end = ip.find(':', end + 1)
+                ip = ip[:end] + '::/64'
             self.records[ip].append((username, count))
+        self._sorted_keys = sorted(self.records)
 
         # Update DB last_seen field for used ranges.
         for ip_range in used_ranges:
@@ -232,33 +433,50 @@ class Whitelist:
     def create_f2b_draft_file(self):
         """Create comments text explaining why IPs are in ignore list."""
 
-        rec_keys = list(self.records.keys())
-        rec_keys.sort()
+        rec_keys = self._sorted_keys
+
+        whois = self.whois_infos(rec_keys)
+
+        # Sort IPs into whitelist categories in one pass.
+        hard, soft, indiv, unused = list(), list(), list(), list()
+        for key in rec_keys:
+            recs = self.records[key]
+            n_users = len(recs)
+            if n_users > 3:
+                hard.append(f'    {key:25} ; - {whois[key]:21} - {n_users:2} {str(recs)}\n')
+            elif n_users > 1:
+                soft.append(f'    {key:25} ; - {whois[key]:21} - {str(recs)}\n')
+            elif recs[0][1] >= 3:
+                indiv.append(f'    {key:25} ; - {whois[key]:21} - {recs}\n')
+            else:
+                unused.append(f'    # {key:25} - {whois[key]} - {recs}\n')
+
+        # Assemble whole draft from parts and join it just once.
+        parts = [IGNORES_HEADER, '\n[DEFAULT]\n\nignoreip_local =\n\n', '# Hard whitelist\n\n']
+        parts.extend(hard)
+        parts.append('\n\n# soft whitelist\n\n')
+        parts.extend(soft)
+        parts.append('\n\n# individuals whitelist\n\n')
+        parts.extend(indiv)
+        parts.append('\n\n# not used IPs to whitelist\n\n')
+        parts.extend(unused)
+        self.draft = ''.join(parts)
+
+        self.write_f2b_draft_file()
+
+    def write_f2b_draft_file(self):
+        """Write fail2ban ignoreip draft file, keep previous one as .bak"""
+
+        # Write complete new file aside first, so crash can't leave half-written draft.
+        tmp_fname = f'{IGNORE_DRAFT_FNAME}.tmp'
+        with open(tmp_fname, 'w') as file:
+            file.write(self.draft)
 
         # Backup existing file
         if Path(IGNORE_DRAFT_FNAME).exists():
-            Path(IGNORE_DRAFT_FNAME).rename(f'{IGNORE_DRAFT_FNAME}.bak')
-
-        # Write fail2ban ignoreip draft file
-        with open(IGNORE_DRAFT_FNAME, 'w') as file:
-            file.write(IGNORES_HEADER)
-            file.write(f'\n[DEFAULT]\n\nignoreip_local =\n\n')
-            file.write("# Hard whitelist\n\n")
-            for key in rec_keys:
-                if len(self.records[key]) > 3:
-                    file.write(f'    {key:25} ; - {whois_bits(key):21} - {len(self.records[key]):2} {str(self.records[key])}\n')
-            file.write("\n\n# soft whitelist\n\n")
-            for key in rec_keys:
-                if len(self.records[key]) > 1 and len(self.records[key]) <= 3 :
-                    file.write(f'    {key:25} ; - {whois_bits(key):21} - {str(self.records[key])}\n')
-            file.write("\n\n# individuals whitelist\n\n")
-            for key in rec_keys:
-                if len(self.records[key]) == 1 and self.records[key][0][1] >= 3:
-                    file.write(f'    {key:25} ; - {whois_bits(key):21} - {self.records[key]}\n')
-            file.write("\n\n# not used IPs to whitelist\n\n")
-            for key in rec_keys:
-                if len(self.records[key]) <= 1 and self.records[key][0][1] < 3:
-                    file.write(f'    # {key:25} - {whois_bits(key)} - {self.records[key]}\n')
+            os.replace(IGNORE_DRAFT_FNAME, f'{IGNORE_DRAFT_FNAME}.bak')
+        # Atomic on POSIX
+        os.replace(tmp_fname, IGNORE_DRAFT_FNAME)
 
     def db_empty(self):
         """Delete all records form database - for debugging purposes only."""
@@ -269,7 +487,9 @@ class Whitelist:
     def db_delete_old_records(self):
 
         delete_until = datetime.now() - timedelta(days=RECORDS_MAX_AGE)
-        self.db_conn.execute('DELETE FROM journal WHERE timestamp < ?', (delete_until.strftime('%Y-%m-%dT%H:%M:%S'), ))
+        self.db_conn.execute('DELETE FROM journal WHERE timestamp < ?', (int(delete_until.timestamp()), ))
+        whois_until = datetime.now() - timedelta(days=WHOIS_MAX_AGE)
+        self.db_conn.execute('DELETE FROM whois_cache WHERE fetched_at < ?', (whois_until.strftime('%Y-%m-%dT%H:%M:%S'), ))
         self.db_conn.commit()
 
 
@@ -286,6 +506,9 @@ if __name__ == '__main__':
             print("\n\nParameter must be existing log file. Or try --help.\n\n")
             sys.exit()
 
+    if not Path(LOG_FILENAME).exists():
+        Path(LOG_FILENAME).touch(mode=0o640)
+
     wl = Whitelist()
     wl.db_delete_old_records()
     wl.process_new_log_records()